@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
 
 import os
+import io
 import json
+import time
 import shutil
 import logging
 import subprocess
 from argparse import ArgumentParser
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import boto3
 import yaml
 
 from unity_app_generator import interface as build_interface
 
-from ..mdps.tool import MdpsTool
+from ..mdps.tool import MdpsTool, mdps_environment
+from ..mdps.aws import ssm_client
 
 # Deploy artifacts back to this repo
 APP_STATE_DIRNAME = ".app_state"
@@ -37,11 +41,49 @@ SOURCE_CWL_ARTIFACT_FILENAME = "process.cwl"
 DEST_CWL_ARTIFACT_FILENAME = "process-{project_name}-{venue_name}.cwl"
 EXAMPLE_JOB_INPUT_FILENAME = "example_job_input.json"
 
+# Seconds a venue name loaded from the parameter store is reused
+VENUE_NAME_CACHE_TTL = 300
+
+# Venue names keyed by project and venue along with when they expire
+_venue_name_cache = {}
+
 logger = logging.getLogger()
 
+def get_venue_name(project_name, venue_name):
+    "Load MDPS venue name from AWS parameter store, reusing recent lookups"
+
+    cache_key = (project_name, venue_name)
+
+    cached = _venue_name_cache.get(cache_key)
+    if cached is not None and time.time() < cached[1]:
+        return cached[0]
+
+    response = ssm_client().get_parameter(Name=f"/unity/{project_name}/{venue_name}/venue-name")
+    value = response['Parameter']['Value']
+
+    _venue_name_cache[cache_key] = (value, time.time() + VENUE_NAME_CACHE_TTL)
+
+    return value
+
+def make_cwl_template(cwl_filename):
+    "Return the YAML job input template cwltool creates for a CWL file"
+
+    try:
+        from cwltool.main import main as cwltool_main
+    except ImportError:
+        # Use the cwltool executable when it is not importable from this environment
+        return subprocess.check_output(["cwltool", "--make-template", cwl_filename])
+
+    # Run in process to avoid starting a new interpreter and importing cwltool again
+    template_output = io.StringIO()
+    if cwltool_main(argsl=["--make-template", cwl_filename], stdout=template_output) != 0:
+        raise Exception(f"cwltool could not create a job input template for {cwl_filename}")
+
+    return template_output.getvalue()
+
 class DeployApp(MdpsTool):
 
-    def __init__(self, app_name, env_config_file=None, deploy_base_dir=None, **kwargs):
+    def __init__(self, app_name, env_config_file=None, deploy_base_dir=None, store_venue_name=None, **kwargs):
         super().__init__(env_config_file=env_config_file)
 
         self.app_name = app_name
@@ -49,15 +91,16 @@ class DeployApp(MdpsTool):
         assert deploy_base_dir is not None
         self.deploy_base_dir = deploy_base_dir
 
-        self._verify_project_venue_name(self.mdps_project, self.mdps_venue)
+        self._verify_project_venue_name(self.mdps_project, self.mdps_venue, store_venue_name)
 
-    def _verify_project_venue_name(self, project_name, venue_name):
-        "Load MDPS venue name from AWS parameter store"
+    def _verify_project_venue_name(self, project_name, venue_name, store_venue_name=None):
+        "Verify the MDPS venue name matches the one in the AWS parameter store"
 
-        client = boto3.client('ssm')
-        response = client.get_parameter(Name=f"/unity/{project_name}/{venue_name}/venue-name")
+        # The parameter store value can be looked up ahead of time by the caller
+        if store_venue_name is None:
+            store_venue_name = get_venue_name(project_name, venue_name)
 
-        assert(response['Parameter']['Value'] == venue_name)
+        assert(store_venue_name == venue_name)
 
     @property
     def app_state_dir(self):
@@ -138,7 +181,7 @@ class DeployApp(MdpsTool):
         else:
             ex_inp_contents = None
 
-        yaml_output = subprocess.check_output(f"cwltool --make-template {dest_cwl_fn}", shell=True)
+        yaml_output = make_cwl_template(dest_cwl_fn)
         yaml_contents = yaml.safe_load(yaml_output)
 
         # Update template with existing file so any manually modified values are preserved
@@ -150,6 +193,23 @@ class DeployApp(MdpsTool):
         with open(example_job_filename, "w") as ex_file:
             json.dump(ex_inp_contents, ex_file, indent=2)
 
+def setup_logging(verbose=False):
+
+    if verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+def build_one_app(app_name, args, store_venue_name=None):
+    "Build, push and capture deployment artifacts for a single application"
+
+    app_deploy = DeployApp(app_name, deploy_base_dir=args.deploy_base_dir, store_venue_name=store_venue_name)
+    app_deploy.init_repo(getattr(args, app_name))
+    if not args.skip_build:
+        app_deploy.build_app(args.docker_tag)
+    app_deploy.deploy_for_venue()
+    app_deploy.update_artifacts()
+
 def main():
 
     parser = ArgumentParser(description="Build TROPESS apps for deployment in MDPS")
@@ -171,15 +231,15 @@ def main():
     parser.add_argument("--deployment_dir", dest="deploy_base_dir", default=os.curdir,
         help="Location where CWL artifacts are deployed")
 
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+        help="Number of applications to build at the same time, by default they are built one after another")
+
     parser.add_argument("--verbose", "-v", action="store_true", default=False,
         help=f"Enable verbose logging")
 
     args = parser.parse_args()
 
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG)
-    else:
-        logging.basicConfig(level=logging.INFO)
+    setup_logging(args.verbose)
 
     if args.app is None or len(args.app) == 0:
         app_list = default_app_list
@@ -190,12 +250,30 @@ def main():
         if app_name not in SOURCE_REPOS:
             raise Exception(f"Unknown application: {app_name}")
 
-        app_deploy = DeployApp(app_name, deploy_base_dir=args.deploy_base_dir)
-        app_deploy.init_repo(getattr(args, app_name))
-        if not args.skip_build:
-            app_deploy.build_app(args.docker_tag)
-        app_deploy.deploy_for_venue()
-        app_deploy.update_artifacts()
+    if args.jobs <= 1 or len(app_list) == 1:
+        for app_name in app_list:
+            build_one_app(app_name, args)
+        return
+
+    # Look up the venue name once and hand the value to each worker
+    mdps_project, mdps_venue, _ = mdps_environment()
+    store_venue_name = get_venue_name(mdps_project, mdps_venue)
+
+    # Workers are spawned instead of forked so they never inherit the boto3 client used for the lookup,
+    # logging is set up again in each since they start from a fresh interpreter
+    mp_context = multiprocessing.get_context("spawn")
+    max_workers = min(args.jobs, len(app_list))
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context, initializer=setup_logging, initargs=(args.verbose,)) as executor:
+        futures = { executor.submit(build_one_app, app_name, args, store_venue_name): app_name for app_name in app_list }
+
+        # Report the first failure right away and do not start builds still waiting for a worker
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logger.error(f"Building {futures[future]} failed, cancelling builds that have not started")
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -4,84 +4,80 @@
 
 import os
 import logging
-import requests
 
 from pprint import pformat
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 
 import argparse
 
-from unity_sds_client.resources.collection import Collection
+from prettytable import PrettyTable
 
-# TROPESS packages
-from tropess_product_spec.schema import CollectionGroup
-
-
-from ..data.tool import DataTool
+from .. import fast_json
+from ..data.tool import DataTool, get_collection_group
+from ..mdps.http import create_session
 
 # metadata used within the MDPS data store for TROPESS products
-CUSTOM_METADATA_DEF = {
-    "tag": {
-        "type": "keyword",
-    },
-    "project": {
-        "type": "keyword",
-    },
-    "short_name": {
-        "type": "keyword",
-    },
-    "long_name": {
-        "type": "keyword",
-    },
-    "doi": {
-        "type": "keyword",
-    },
-    "collection_group": {
-        "type": "keyword",
-    },
-    "product_stage": {
-        "type": "keyword",
-    },
-    "product_type": {
-        "type": "keyword",
-    },
-    "sensor_set": {
-        "type": "keyword",
-    },
-    "species": {
-        "type": "keyword",
-    },
-    "product_version": {
-        "type": "keyword",
-    },
-    "processing_batch": {
-        "type": "keyword",
-    },
-    "processing_profile": {
-        "type": "keyword",
-    },
-    "processing_datetime": {
-        "type": "date",
-    },
-    "retrieval_step": {
-        "type": "date",
-    }
-}
+CUSTOM_METADATA_DEF = MappingProxyType({
+    "tag": { "type": "keyword" },
+    "project": { "type": "keyword" },
+    "short_name": { "type": "keyword" },
+    "long_name": { "type": "keyword" },
+    "doi": { "type": "keyword" },
+    "collection_group": { "type": "keyword" },
+    "product_stage": { "type": "keyword" },
+    "product_type": { "type": "keyword" },
+    "sensor_set": { "type": "keyword" },
+    "species": { "type": "keyword" },
+    "product_version": { "type": "keyword" },
+    "processing_batch": { "type": "keyword" },
+    "processing_profile": { "type": "keyword" },
+    "processing_datetime": { "type": "date" },
+    "retrieval_step": { "type": "date" },
+})
 
 DEFAULT_ARCHIVING_TYPES = [ ".nc" ]
 
+# Archive config values shown when checking registered archive configs
+ARCHIVE_CONFIG_FIELDS = ("daac_collection_id", "daac_data_version", "daac_provider", "daac_sns_topic_arn")
+
+# Maximum number of concurrent per collection requests made to data services
+MAX_REQUEST_WORKERS = 8
+
 logger = logging.getLogger()
 
 class TropessDataInit(DataTool):
+
+    def __init__(self, *vargs, **kwargs):
+        super().__init__(*vargs, **kwargs)
+
+        # Reuse connections to the DAPA endpoint across requests, request bodies are encoded with fast_json
+        self._http = create_session()
+        self._http.headers["Content-Type"] = "application/json"
+
+        # Base URL for per collection DAPA requests
+        self._dapa_base = self.data_manager.endpoint.rstrip("/") + "/am-uds-dapa/collections/"
+
+        # Custom metadata fields returned for each collection id
+        self._variables_cache = {}
+
     # %%%%%%%%%%%%%%%%%%%%%%%
     # Register collection ids
     
     def register_mdps_collection_ids(self, mdps_collection_ids):
         "Register MDPS collection IDs with data services"
 
+        from unity_sds_client.resources.collection import Collection
+
         # This is an asynchronous operation, so there may be a delay in the request for a collection creation and when it shows up in the response.
         for mdps_collection_id in mdps_collection_ids:
             logger.info(f"Registering collection id: {mdps_collection_id}")
-            self.data_manager.create_collection(Collection(mdps_collection_id))
+
+        with ThreadPoolExecutor(max_workers=MAX_REQUEST_WORKERS) as executor:
+            list(executor.map(lambda cid: self.data_manager.create_collection(Collection(cid)), mdps_collection_ids))
+
+        # Any cached collection listing no longer reflects what is registered
+        self._collections_cache.clear()
 
         logger.info(f"{len(mdps_collection_ids)} collection ids requested")
 
@@ -91,10 +87,8 @@ class TropessDataInit(DataTool):
             logger.warning("No TROPESS collection ids to check")
             return
 
-        mdps_collection_ids = []
-        for c in self.data_manager.get_collections(limit=1e4):
-            mdps_collection_ids.append(c.collection_id)
-        
+        mdps_collection_ids = { c.collection_id for c in self._collections(limit=1e4) }
+
         for collection_id in our_collection_ids:
             if collection_id in mdps_collection_ids:
                 logger.info(f"{collection_id} created succesfully")
@@ -103,7 +97,7 @@ class TropessDataInit(DataTool):
 
     def register_collection_ids(self, collection_group_keyword, granule_version, muses_collection_version, do_update=False, check_update=False, **kwargs):
 
-        collection_group_obj = CollectionGroup.get_collection_group(collection_group_keyword)
+        collection_group_obj = get_collection_group(collection_group_keyword)
 
         tropess_short_names = self.collection_group_short_names(collection_group_obj)
         mdps_collection_ids = list(self.mdps_collection_ids(tropess_short_names, granule_version))
@@ -123,46 +117,97 @@ class TropessDataInit(DataTool):
     # %%%%%%%%%%%%%%%
     # Custom Metadata
 
-    def existing_custom_metadata(self, limit=None):
-        "Returns metadata fields already defined for MDPS collection ids"
+    def collection_variables(self, collection_id):
+        "Returns metadata fields defined for a single MDPS collection id"
+
+        if collection_id in self._variables_cache:
+            return self._variables_cache[collection_id]
 
         # Hack an accessor until unity-sds-client supports this
+        url = f"{self._dapa_base}{collection_id}/variables"
+        response = self._http.get(url, headers=self._auth_header())
+            
+        if response.status_code != 200:
+            if hasattr(response, "message"):
+                raise Exception("Error: " + response.message)
+            else:
+                raise Exception(f"Error: {response.json()}")
+
+        self._variables_cache[collection_id] = fast_json.loads(response.content)
+        return self._variables_cache[collection_id]
+
+    def existing_custom_metadata(self, limit=None, only_check_missing=False):
+        "Returns metadata fields already defined for MDPS collection ids"
+
+        # With only_check_missing, collections stop being queried once all of our own fields have been seen,
+        # other fields in the result may then be incomplete, but the values of our own fields are final
+
+        collection_ids = [ c.collection_id for c in self._collections(limit=limit) ]
+
+        # Fetch the token once up front instead of from each worker
+        self._auth_header()
+
         existing_metadata = {}
-        for c in self.data_manager.get_collections(limit=limit):
-            url = self.data_manager.endpoint + f"am-uds-dapa/collections/{c.collection_id}/variables"
-            token = self.data_manager._session.get_auth().get_token()
-            response = requests.get(url, headers={"Authorization": "Bearer " + token})
-                
-            if response.status_code != 200:
-                if hasattr(response, "message"):
-                    raise Exception("Error: " + response.message)
-                else:
-                    raise Exception(f"Error: {response.json()}")
-                
-            existing_metadata.update(response.json())
+        with ThreadPoolExecutor(max_workers=MAX_REQUEST_WORKERS) as executor:
+            if not only_check_missing:
+                # Merge in collection order so later collections take precedence as before
+                for collection_vars in executor.map(self.collection_variables, collection_ids):
+                    existing_metadata.update(collection_vars)
+
+                return existing_metadata
+
+            # Walk back from the last collection one batch at a time keeping the first definition seen of each field,
+            # which is the one that takes precedence, so our fields are final once they have all been seen
+            collection_ids.reverse()
+            for batch_start in range(0, len(collection_ids), MAX_REQUEST_WORKERS):
+                batch_ids = collection_ids[batch_start:batch_start + MAX_REQUEST_WORKERS]
+
+                for collection_vars in executor.map(self.collection_variables, batch_ids):
+                    for field_name, field_def in collection_vars.items():
+                        existing_metadata.setdefault(field_name, field_def)
+
+                if CUSTOM_METADATA_DEF.keys() <= existing_metadata.keys():
+                    break
 
         return existing_metadata
 
-    def define_custom_metadata(self, do_update=False, **kwargs):
+    def define_custom_metadata(self, do_update=False, skip_existing_check=False, **kwargs):
         "Define custom metadata fields for all future ingested products to the current venue"
 
         # Custom metadata fields are defined for a given project and venue. The metadata fields can then be used as additional properties in the STAC item file associated with the data. Note that all previously defined custom metadata fields must be included in the call to define_custom_metadata.
 
         # We query for existing custom metadata to ensure we do not overwrite what has already been defined in our update.
-        logger.info("Querying MDPS data services for existing custom metadata")
-        existing_metadata_fields = self.existing_custom_metadata()
-        custom_metadata_fields = existing_metadata_fields.copy()
+        if skip_existing_check:
+            if do_update:
+                raise Exception("Existing custom metadata must be checked when committing an update")
 
-        # Update existing metadata with our definitions
-        custom_metadata_fields.update(CUSTOM_METADATA_DEF)
+            logger.warning("Not querying for existing custom metadata, all proposed fields are shown")
+            existing_metadata_fields = {}
+        else:
+            logger.info("Querying MDPS data services for existing custom metadata")
+            # A dry run only reports on our own fields, but an update must carry forward every existing field
+            existing_metadata_fields = self.existing_custom_metadata(only_check_missing=not do_update)
 
-        logger.info("Custom metadata fields definition:\n" + pformat(custom_metadata_fields, indent=2))
+        # Only our definitions can differ from what already exists
+        changed_fields = { k: v for k, v in CUSTOM_METADATA_DEF.items() if existing_metadata_fields.get(k) != v }
 
-        if custom_metadata_fields == existing_metadata_fields:
+        if len(changed_fields) == 0:
             logger.info("Proposed fields match existing fields")
+        elif logger.isEnabledFor(logging.INFO):
+            logger.info("Custom metadata fields to add or change:\n" + pformat(changed_fields, indent=2))
 
         # Declare new custom metadata fields
-        if do_update:
+        if do_update and len(changed_fields) == 0:
+            logger.info("No custom metadata committed, existing definition is already up to date")
+        elif do_update:
+            # Update existing metadata with our definitions
+            custom_metadata_fields = existing_metadata_fields
+            # Copy each field definition so the payload never shares them with CUSTOM_METADATA_DEF
+            custom_metadata_fields.update({ k: dict(v) for k, v in CUSTOM_METADATA_DEF.items() })
+
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Custom metadata fields definition:\n" + pformat(custom_metadata_fields, indent=2))
+
             logger.info("Committing custom metadata definition")
             self.data_manager.define_custom_metadata(custom_metadata_fields)
         else:
@@ -178,9 +223,8 @@ class TropessDataInit(DataTool):
         "Returns archive configuration for a collection id"
 
         # Hack an accessor until unity-sds-client supports this
-        url = self.data_manager.endpoint + f"am-uds-dapa/collections/{collection_id}/archive"
-        token = self.data_manager._session.get_auth().get_token()
-        response = requests.get(url, headers={"Authorization": "Bearer " + token})
+        url = f"{self._dapa_base}{collection_id}/archive"
+        response = self._http.get(url, headers=self._auth_header())
         
         if response.status_code != 200:
             if hasattr(response, "message"):
@@ -188,15 +232,14 @@ class TropessDataInit(DataTool):
             else:
                 raise Exception(f"Error: {response.json()}")
             
-        return response.json()
+        return fast_json.loads(response.content)
 
     def add_archive_config(self, mdps_collection_id, daac_collection_id, daac_data_version, daac_sns_topic_arn, 
                            daac_role_arn, daac_role_session_name, daac_provider,
                            archiving_types=DEFAULT_ARCHIVING_TYPES, do_update=False):
 
         # Hack an accessor until unity-sds-client supports this
-        url = self.data_manager.endpoint + f"am-uds-dapa/collections/{mdps_collection_id}/archive"
-        token = self.data_manager._session.get_auth().get_token()
+        url = f"{self._dapa_base}{mdps_collection_id}/archive"
 
         data = {
             "daac_collection_id": daac_collection_id,
@@ -211,12 +254,13 @@ class TropessDataInit(DataTool):
             }]
         }
 
-        logger.info("Archive configuration:\n" + pformat(data, indent=2))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Archive configuration:\n" + pformat(data, indent=2))
 
         if do_update:
             logger.info("Committing archive configuration")
 
-            response = requests.put(url, headers={"Authorization": "Bearer " + token}, json=data)
+            response = self._http.put(url, headers=self._auth_header(), data=fast_json.dumpb(data))
             
             if response.status_code != 200:
                 if hasattr(response, "message"):
@@ -224,7 +268,7 @@ class TropessDataInit(DataTool):
                 else:
                     raise Exception(f"Error: {response.json()}")
                 
-            return response.json()
+            return fast_json.loads(response.content)
         else:
             logger.info("No archive configuration committed, dry run only")
 
@@ -234,14 +278,13 @@ class TropessDataInit(DataTool):
     def delete_archive_config(self, mdps_collection_id, daac_collection_id):
 
         # Hack an accessor until unity-sds-client supports this
-        url = self.data_manager.endpoint + f"am-uds-dapa/collections/{mdps_collection_id}/archive"
-        token = self.data_manager._session.get_auth().get_token()
+        url = f"{self._dapa_base}{mdps_collection_id}/archive"
 
         data = {
             "daac_collection_id": daac_collection_id,
         }
 
-        response = requests.delete(url, headers={"Authorization": "Bearer " + token}, json=data)
+        response = self._http.delete(url, headers=self._auth_header(), data=fast_json.dumpb(data))
         
         if response.status_code != 200:
             if hasattr(response, "test"):
@@ -251,29 +294,61 @@ class TropessDataInit(DataTool):
             else:
                 raise Exception(f"Error: {response.json()}")
             
-        return response.json()
+        return fast_json.loads(response.content)
 
     def register_daac_archiving(self, collection_group_keyword, granule_version, sns_arn,  
                                 role_arn, role_session_name, provider,
-                                do_update=False, delete=False, **kwargs):
+                                do_update=False, delete=False, verify=True, **kwargs):
 
-        collection_group_obj = CollectionGroup.get_collection_group(collection_group_keyword)
+        collection_group_obj = get_collection_group(collection_group_keyword)
 
-        tropess_short_names = self.collection_group_short_names(collection_group_obj)
-        mdps_collection_ids = list(self.mdps_collection_ids(tropess_short_names, granule_version))        
+        # DAAC collection ids paired with MDPS collection ids
+        archive_pairs = list(self._daac_pairs(collection_group_obj, granule_version))
         
-        if delete:
-            for daac_id, mdps_id in zip(tropess_short_names, mdps_collection_ids):
-                logger.info(f"Deleting DAAC archive id: {daac_id} to {mdps_id}")
-                self.delete_archive_config(mdps_id, daac_id)
- 
-        for daac_id, mdps_id in zip(tropess_short_names, mdps_collection_ids):
+        def _delete(daac_id, mdps_id):
+            logger.info(f"Deleting DAAC archive id: {daac_id} to {mdps_id}")
+            return self.delete_archive_config(mdps_id, daac_id)
+
+        def _register(daac_id, mdps_id):
             logger.info(f"Registering DAAC archive id: {daac_id} to {mdps_id}")
-            self.add_archive_config(mdps_id, daac_id, granule_version, sns_arn, role_arn, role_session_name, provider, do_update=do_update)
+            return self.add_archive_config(mdps_id, daac_id, granule_version, sns_arn, role_arn, role_session_name, provider, do_update=do_update)
+
+        # Fetch the token once up front instead of from each worker
+        if delete or do_update or verify:
+            self._auth_header()
+
+        # Each stage runs concurrently across collections, but all deletes finish before any configs are added
+        with ThreadPoolExecutor(max_workers=MAX_REQUEST_WORKERS) as executor:
+            if delete:
+                list(executor.map(lambda pair: _delete(*pair), archive_pairs))
+ 
+            list(executor.map(lambda pair: _register(*pair), archive_pairs))
+
+            if verify:
+                archive_cfgs = list(executor.map(lambda pair: self.get_archive_config(pair[1]), archive_pairs))
+
+        if verify and logger.isEnabledFor(logging.INFO):
+            logger.info("Archive configs after registering:\n" + str(self.archive_config_table(archive_pairs, archive_cfgs)))
 
-        for collection_id in mdps_collection_ids:
-            archive_cfg = self.get_archive_config(collection_id)
-            logger.info(f"Archive config for {collection_id}:\n" + pformat(archive_cfg, indent=2))
+    def archive_config_table(self, archive_pairs, archive_cfgs):
+        "Summarize archive configs with one row per DAAC collection id configured for each MDPS collection id"
+
+        table = PrettyTable()
+        table.field_names = ["MDPS Collection ID"] + list(ARCHIVE_CONFIG_FIELDS)
+        table.align = 'l'
+
+        for (_, collection_id), archive_cfg in zip(archive_pairs, archive_cfgs):
+            # A collection may have several archive configs or none at all
+            if isinstance(archive_cfg, dict):
+                archive_cfg = [ archive_cfg ]
+
+            if len(archive_cfg) == 0:
+                table.add_row([collection_id] + ["" for _ in ARCHIVE_CONFIG_FIELDS])
+
+            for cfg in archive_cfg:
+                table.add_row([collection_id] + [ cfg.get(field, "") for field in ARCHIVE_CONFIG_FIELDS ])
+
+        return table
 
 # %%%%%%%%%%%%%%%
 # Main
@@ -313,6 +388,9 @@ def main():
     parser_metadata = subparsers.add_parser('custom_metadata',
         help=f"Registers custom metadata needed by py_tropess output")
     
+    parser_metadata.add_argument("--skip_existing_check", action="store_true", default=False,
+        help="Show the proposed fields without querying for existing ones, only allowed for a dry run")
+
     parser_metadata.set_defaults(func=TropessDataInit.define_custom_metadata)
 
     # register DAAC archive delivery
@@ -341,6 +419,9 @@ def main():
     parser_archive.add_argument("--delete", dest="delete", action="store_true", default=False,
         help="Delete DAAC archive configs before creating, or delete configs if not committing updates")
 
+    parser_archive.add_argument("--verify", dest="verify", action=argparse.BooleanOptionalAction, default=True,
+        help="Query and display the archive configs of the collection ids after registering, on by default")
+
     parser_archive.set_defaults(func=TropessDataInit.register_daac_archiving)
      
     # final argument processing
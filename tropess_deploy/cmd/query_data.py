@@ -4,9 +4,10 @@
 
 import os
 
-import dateparser
 from datetime import datetime, timedelta
 import calendar
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import argparse
 
@@ -14,32 +15,48 @@ from prettytable import PrettyTable
 
 import logging
 
-import json
+from .. import fast_json
+from ..data.tool import DataTool, get_collection_group, date_ymd, QUERY_WORKERS
 
-# Import both because the first initiates beginning in the config
-import tropess_product_spec.config as tps_config
-from tropess_product_spec.schema import CollectionGroup
+logger = logging.getLogger()
 
-from ..data.tool import DataTool
+# archive_status value of a product successfully archived at the DAAC
+ARCHIVED_STATUS = "cnm_r_success"
+
+# Tables with more rows than this are printed without PrettyTable
+PRETTY_TABLE_MAX_ROWS = 100
+
+# Marks a property missing from a feature, as opposed to one defined with a null value
+_UNDEFINED = object()
+
+def print_rows(field_names, rows):
+    "Print rows as left aligned columns sized to their widest value"
+
+    str_rows = [ [ str(value) for value in row ] for row in rows ]
+    widths = [ max(map(len, column)) for column in zip(field_names, *str_rows) ]
+    row_fmt = "  ".join(f"{{:<{width}}}" for width in widths)
+
+    print(row_fmt.format(*field_names))
+    print("  ".join("-" * width for width in widths))
+    print("\n".join(row_fmt.format(*row) for row in str_rows))
 
-logger = logging.getLogger()
 class DataQuery(DataTool):
 
     def feat_is_archived(self, feat):
-        is_archived = 'archive_status' in feat['properties'] and feat['properties']['archive_status'] == "cnm_r_success"
-        return is_archived
+        return feat['properties'].get('archive_status') == ARCHIVED_STATUS
 
     def stac_date_status(self, stac):
 
-        date_status = {}
+        # Count of features and archived features per date, date_ymd is memoized so repeated datetimes are not parsed again
+        date_counts = defaultdict(lambda: [0, 0])
         for feat in stac['features']:
-            processing_date = dateparser.parse(feat['properties']['processing_datetime']).strftime("%Y-%m-%d")        
-            is_archived = self.feat_is_archived(feat)
-            date_info = date_status[processing_date] = date_status.get(processing_date, {})
-            date_info['count'] = date_info.get('count', 0) + 1
-            date_info['num_archived'] = date_info.get('num_archived', 0) + (1 if is_archived else 0)
-        
-        return date_status
+            props = feat['properties']
+            counts = date_counts[date_ymd(props['processing_datetime'])]
+            counts[0] += 1
+            counts[1] += props.get('archive_status') == ARCHIVED_STATUS
+
+        return { processing_date: {'count': count, 'num_archived': num_archived}
+                 for processing_date, (count, num_archived) in date_counts.items() }
 
     def get_constant_property(self, stac, prop_name, required=True):
         "Loop over metadata and ensure that all items have the same value for metadata_name"
@@ -47,36 +64,63 @@ class DataQuery(DataTool):
         if 'features' not in stac:
             return
 
+        return self.constant_properties(stac, [prop_name], required)[prop_name]
+
+    def constant_properties(self, stac, prop_names, required=True):
+        "Ensure that all items have the same value for each of prop_names"
+
+        feat_props = [ feat['properties'] for feat in stac['features'] ]
+
+        prop_values = {}
+        for prop_name in prop_names:
+            # Collecting the distinct values into a set is quick when all items agree as expected
+            try:
+                values = { props.get(prop_name, _UNDEFINED) for props in feat_props }
+            except TypeError:
+                values = None
+
+            if values is not None and len(values) == 1 and _UNDEFINED not in values:
+                prop_values[prop_name] = values.pop()
+            else:
+                # Walk the items to report exactly where they are missing or disagree
+                prop_values[prop_name] = self._checked_property(stac, prop_name)
+
+        if required:
+            for prop_name, prop_value in prop_values.items():
+                if prop_value is None:
+                    raise Exception(f"No datasets define the {prop_name} metadata")
+
+        return prop_values
+
+    def _checked_property(self, stac, prop_name):
+        "Value of prop_name shared by all items, reporting items that do not define it and raising on a mismatch"
+
         prop_value = None
         for feat in stac['features']:
-            if prop_name not in feat['properties']:
+            curr_value = feat['properties'].get(prop_name, _UNDEFINED)
+            if curr_value is _UNDEFINED:
                 print(f"{feat['id']} does not define {prop_name}")
                 continue
 
-            curr_value = feat['properties'][prop_name]
             if prop_value is not None and prop_value != curr_value:
                 raise Exception(f"{prop_name} does not have a consistent value {curr_value} for {feat['id']}, expected {prop_value}")
             prop_value = curr_value
 
-        if prop_value is None and required:
-            raise Exception(f"No datasets define the {prop_name} metadata")
-
         return prop_value
 
     def data_catalog_collection_ids(self, prefix=None):
         "Retrieve collection IDs from the data catalog"
         
-        catalog_collection_ids = []
-        for collection_result in self.data_manager.get_collections(limit=None):
-            if prefix is None or collection_result.collection_id.find(":" + prefix) >- 0:
-                catalog_collection_ids.append(collection_result.collection_id)
+        # The data catalog can not filter collections by name, so match them here
+        id_part = None if prefix is None else ":" + prefix
 
-        return catalog_collection_ids
+        return [ collection_result.collection_id for collection_result in self._collections()
+                 if id_part is None or id_part in collection_result.collection_id ]
 
     def data_catalog_query(self, collection_ids, processing_date, date_range, query_limit):
+        "Query the data catalog for each collection id, returning (collection id, STAC result) pairs in the same order as the ids"
 
-        for curr_id in collection_ids:
-            yield super().query_data_catalog(curr_id, processing_date=processing_date, date_range=date_range, limit=query_limit)
+        return self.query_data_catalog_many(collection_ids, processing_date=processing_date, date_range=date_range, limit=query_limit)
 
     def display_collection_ids(self, prefix):
         
@@ -88,22 +132,26 @@ class DataQuery(DataTool):
         table = PrettyTable(header=False)
         table.align = 'l'
 
+        props = self.constant_properties(stac, ["collection_group", "sensor_set", "product_stage", "product_version"])
+
         table.add_row(["Collection ID", collection_id])
-        table.add_row(["Collection Group", self.get_constant_property(stac, "collection_group")])
-        table.add_row(["Sensor Set", self.get_constant_property(stac, "sensor_set")])
+        table.add_row(["Collection Group", props["collection_group"]])
+        table.add_row(["Sensor Set", props["sensor_set"]])
 
-        product_stage = self.get_constant_property(stac, "product_stage")
+        product_stage = props["product_stage"]
         table.add_row(["Product Stage", product_stage])
 
+        # MUSES products do not define these properties
         if product_stage != "MUSES":
-            table.add_row(["Product Type", self.get_constant_property(stac, "product_type")])
-            table.add_row(["Short Name", self.get_constant_property(stac, "short_name")])
-            table.add_row(["Long Name", self.get_constant_property(stac, "long_name")])
+            product_props = self.constant_properties(stac, ["product_type", "short_name", "long_name"])
+            table.add_row(["Product Type", product_props["product_type"]])
+            table.add_row(["Short Name", product_props["short_name"]])
+            table.add_row(["Long Name", product_props["long_name"]])
 
-        table.add_row(["Product Version", self.get_constant_property(stac, "product_version")])
+        table.add_row(["Product Version", props["product_version"]])
         
         if processing_date is not None:
-            table.add_row(["Date", dateparser.parse(processing_date).strftime("%Y-%m-%d")])
+            table.add_row(["Date", date_ymd(processing_date)])
         else:
             table.add_row(["Num Dates", len(self.stac_date_status(stac))])
 
@@ -124,31 +172,39 @@ class DataQuery(DataTool):
 
     def display_date_details(self, stac, collection_id):
 
-        table = PrettyTable()
-        table.field_names = ["ID", "Species", "Num Files", "Is Archived"]
-
-        table.align["ID"] = "l"
-        table.align["Species"] = "l"
+        field_names = ["ID", "Species", "Num Files", "Is Archived"]
 
+        rows = []
         for feat in stac['features']:
-            id = feat['id'].replace(collection_id, "").lstrip(":")
+            props = feat['properties']
 
-            table.add_row([
-                id,
-                feat['properties']['species'],
+            rows.append([
+                feat['id'].removeprefix(collection_id).lstrip(":"),
+                props['species'],
                 len(feat['assets']),
-                self.feat_is_archived(feat),
+                props.get('archive_status') == ARCHIVED_STATUS,
             ])
 
-        print(table)
+        # PrettyTable gets slow for large tables, fall back to a plain listing
+        if len(rows) > PRETTY_TABLE_MAX_ROWS:
+            print_rows(field_names, rows)
+            return
 
-    def display_collection_summary(self, mdps_collection_ids, stac_catalogs, processing_date):
+        table = PrettyTable()
+        table.field_names = field_names
 
-        for stac, collection_id in zip(stac_catalogs, mdps_collection_ids):
-            if "features" not in stac:
-                continue
+        table.align["ID"] = "l"
+        table.align["Species"] = "l"
+
+        table.add_rows(rows)
+
+        print(table)
 
-            if 'features' not in stac or len(stac['features']) == 0:
+    def display_collection_summary(self, catalog_results, processing_date):
+
+        for collection_id, stac in catalog_results:
+            # Skip empty results before any per feature work
+            if not stac.get('features'):
                 print(f"{collection_id} is empty.")
                 continue
 
@@ -160,25 +216,34 @@ class DataQuery(DataTool):
             else:
                 self.display_date_details(stac, collection_id)
 
-    def write_stac_files(self, data_collection_ids, stac_catalogs, output_dir):
+    def write_stac_files(self, catalog_results, output_dir):
+
+        output_prefix = os.path.join(output_dir, "")
 
-        for collection_id, stac in zip(data_collection_ids, stac_catalogs):
-            stac_output_filename = os.path.join(output_dir, collection_id + ".stac")
-            self.write_stac_catalog(stac, stac_output_filename)        
+        def _write(result):
+            collection_id, stac = result
+            self.write_stac_catalog(stac, output_prefix + collection_id + ".stac")
 
-    def write_delete_message(self,  data_collection_ids, stac_catalogs, collection_version, output_dir):
+        # Each collection goes to its own file, so they can be written at the same time
+        with ThreadPoolExecutor(max_workers=QUERY_WORKERS) as executor:
+            list(executor.map(_write, catalog_results))
+
+    def write_delete_message(self, catalog_results, collection_version, output_dir):
 
         current_time_string = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
         id_time_string = datetime.now().strftime("%Y%m%dT%H%M%S")
 
-        for collection_id, stac in zip(data_collection_ids, stac_catalogs):
+        # Joined once, file names are appended to this for every product
+        output_prefix = os.path.join(output_dir, "")
+
+        for collection_id, stac in catalog_results:
             if len(stac['features']) == 0:
                 continue
 
             short_name = self.get_constant_property(stac, "short_name")
             
             for feat in stac['features']:
-                product_id = feat['id'].replace(collection_id, "").lstrip(":")
+                product_id = feat['id'].removeprefix(collection_id).lstrip(":")
                 delete_message_id = f"delete-{product_id}-{id_time_string}"
 
                 delete_params = {
@@ -196,11 +261,11 @@ class DataQuery(DataTool):
                     "submissionTime": current_time_string,
                 }
 
-                output_filename = os.path.join(output_dir, delete_message_id + ".json")
+                output_filename = output_prefix + delete_message_id + ".json"
                 logger.info(f"Writing delete message to: {output_filename}")
 
-                with open(output_filename, "w") as delete_msg_file:
-                    json.dump(delete_params, delete_msg_file)
+                with open(output_filename, "wb") as delete_msg_file:
+                    delete_msg_file.write(fast_json.dumpb(delete_params))
     
     def query_data(self, collection_id_prefix, collection_id_func, collection_version, collection_group=None, processing_date=None, date_range=None, query_limit=None, sensor_set_str=None, write_stac_catalog=False, write_delete_message=False, output_dir=None, **kwargs):
         
@@ -210,23 +275,23 @@ class DataQuery(DataTool):
         
         data_collection_ids = collection_id_func(collection_group, collection_version, sensor_set_str)
 
-        stac_catalogs = list(self.data_catalog_query(data_collection_ids, processing_date, date_range, query_limit))
+        catalog_results = self.data_catalog_query(data_collection_ids, processing_date, date_range, query_limit)
             
-        self.display_collection_summary(data_collection_ids, stac_catalogs, processing_date)
+        self.display_collection_summary(catalog_results, processing_date)
         
-        if output_dir is not None and not os.path.exists(output_dir):
+        if output_dir is not None:
             logger.debug(f"Creating directory {output_dir}")
-            os.makedirs(output_dir)
+            os.makedirs(output_dir, exist_ok=True)
 
         if write_stac_catalog:
             if output_dir:
-                self.write_stac_files(data_collection_ids, stac_catalogs, output_dir)
+                self.write_stac_files(catalog_results, output_dir)
             else:
                 logger.warning(f"Can not write STAC catalog files because output directory was not defined")
 
         if write_delete_message:
             if output_dir is not None:
-                self.write_delete_message(data_collection_ids, stac_catalogs, collection_version, output_dir)
+                self.write_delete_message(catalog_results, collection_version, output_dir)
             else:
                 logger.warning(f"Can not write delete message files because output directory was not defined")
  
@@ -328,10 +393,7 @@ def main():
     # Find collection group object from keyword name
     args_dict['collection_group'] = None
     if args_dict['collection_group_keyword'] is not None:
-        collection_group_obj = CollectionGroup.get_collection_group(args_dict['collection_group_keyword'])
-        if collection_group_obj is None:
-            raise Exception(f"Invalid collection_group_keyword: {args_dict['collection_group_keyword']}")
-        args_dict['collection_group'] = collection_group_obj
+        args_dict['collection_group'] = get_collection_group(args_dict['collection_group_keyword'])
 
     query = DataQuery(**args_dict)
 
@@ -3,29 +3,32 @@
 """
 
 import os
-import re
-import json
+import time
+import functools
 
 import argparse
 
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 
 import logging
 
-import requests
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urljoin
 
-from unity_sds_client.resources.collection import Collection
+from .. import fast_json
+from ..data.tool import DataTool, get_collection_group
+from ..mdps.http import create_session
+from ..mdps.aws import s3_client, ssm_client
 
-import boto3
-import yaml
+# Response statuses from GitHub and Airflow that are retried
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
 
-# Import both because the first initiates beginning in the config
-import tropess_product_spec.config as tps_config
-from tropess_product_spec.schema import CollectionGroup
+# Seconds an SSM parameter value is reused before being looked up again
+SSM_CACHE_TTL = 300
 
-from ..data.tool import DataTool
+# Maximum number of concurrent verification requests before triggering a DAG
+VERIFY_WORKERS = 4
 
 REQUEST_INSTANCE_TYPE = "t3.medium"
 REQUEST_STORAGE = "10Gi"
@@ -51,14 +54,40 @@ DEPLOY_FILES_BASE_URL = "https://raw.githubusercontent.com/unity-sds/mdps-tropes
 
 CWL_WORKFLOW_FILENAME = "{subcommand_dir}/process-{project}-{venue}.cwl"
 
+# Empty STAC JSON stored in the repo used as the data ingest stage in
+DATA_INGEST_STAGE_IN_URL = urljoin(DEPLOY_FILES_BASE_URL, f"{SUBCOMMAND_DIRS['data_ingest']}/stage_in.json")
+
 # For verification of S3 URL
 EXPECTED_INGEST_SUBDIRS = ["L2_Products", "L2_Products_Lite"]
 
+def airflow_dag_url(airflow_api_url, dag_name, endpoint):
+    "URL of an Airflow REST API endpoint for a DAG"
+
+    return urljoin(airflow_api_url.rstrip('/') + '/', f"dags/{dag_name}/{endpoint}")
+
 def read_job_file(sub_command, deploy_base_dir):
     param_filename = os.path.join(deploy_base_dir, DEFAULT_JOB_PARAMETER_FILE[sub_command])
 
-    with open(param_filename, "r") as param_file:
-        return json.load(param_file)
+    with open(param_filename, "rb") as param_file:
+        return fast_json.loads(param_file.read())
+
+@functools.lru_cache(maxsize=32)
+def cwl_docker_version(cwl_workflow_filename, mtime=None):
+    "Docker image version of the DockerRequirement in a CWL file"
+
+    import yaml
+
+    # The C loader is much faster than the pure Python one, but is only there when PyYAML was built with libyaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+    with open(cwl_workflow_filename, "r") as yaml_output:
+        yaml_contents = yaml.load(yaml_output, Loader=loader)
+
+    docker_url = yaml_contents['requirements']['DockerRequirement']['dockerPull']
+
+    _, docker_version = docker_url.split(':', 2)
+
+    return docker_version
 
 class TropessDAGRunner(DataTool):
 
@@ -68,16 +97,49 @@ class TropessDAGRunner(DataTool):
         assert deploy_base_dir is not None
         self.deploy_base_dir = deploy_base_dir
 
+        # Reuse connections to the deployment file host across requests
+        self._http = create_session(pool_connections=10, pool_maxsize=10, status_forcelist=HTTP_RETRY_STATUSES)
+
+        # Airflow requests use their own session so its credentials are never sent to other hosts,
+        # DAG trigger POSTs are not idempotent so urllib3 only retries them on connection errors
+        self._airflow = create_session(pool_connections=4, pool_maxsize=8, status_forcelist=HTTP_RETRY_STATUSES)
+        self._airflow.headers.update({
+            "Content-type": "application/json", 
+            "Accept": "text/json",
+        })
+
+        if "AIRFLOW_BASIC_AUTH" in os.environ:
+            self._airflow.headers["Authorization"] = "Basic " + os.environ["AIRFLOW_BASIC_AUTH"]
+
+        # SSM parameter values keyed by project and venue along with when they expire
+        self._ssm_cache = {}
+
+        self._project = self.unity._session._project
+        self._venue = self.unity._session._venue
+
+        # Deployed process CWL file for each subcommand relative to the deployment directory, and the URL where Airflow will find it
+        self._workflow_filenames = { sub: CWL_WORKFLOW_FILENAME.format(subcommand_dir=sub_dir, project=self._project, venue=self._venue)
+                                     for sub, sub_dir in SUBCOMMAND_DIRS.items() }
+        self._workflow_urls = { sub: urljoin(DEPLOY_FILES_BASE_URL, filename)
+                                for sub, filename in self._workflow_filenames.items() }
+        self._workflow_paths = { sub: os.path.join(self.deploy_base_dir, filename)
+                                 for sub, filename in self._workflow_filenames.items() }
+
     def _airflow_api_url(self):
         "Load Airflow API URL from SSM parameter store"
 
-        project_name = self.unity._session._project
-        venue_name = self.unity._session._venue
+        cache_key = (self._project, self._venue)
+
+        cached = self._ssm_cache.get(cache_key)
+        if cached is not None and time.time() < cached[1]:
+            return cached[0]
+
+        response = ssm_client().get_parameter(Name=f"/{self._project}/{self._venue}/sps/processing/airflow/api_url")
+        api_url = response['Parameter']['Value']
 
-        client = boto3.client('ssm')
-        response = client.get_parameter(Name=f"/{project_name}/{venue_name}/sps/processing/airflow/api_url")
+        self._ssm_cache[cache_key] = (api_url, time.time() + SSM_CACHE_TTL)
 
-        return response['Parameter']['Value']
+        return api_url
 
     def trigger_dag(self, process_workflow, run_id, process_args, stac_json, use_ecr=True, use_stac_auth=True, trigger=False, rerun=False):
 
@@ -90,22 +152,17 @@ class TropessDAGRunner(DataTool):
         dag_name = os.getenv("AIRFLOW_DAG_NAME", DEFAULT_DAG_NAME)
 
         if rerun:
-            trigger_url = os.path.join(airflow_api_url, f"dags/{dag_name}/clearTaskInstances")
+            trigger_url = airflow_dag_url(airflow_api_url, dag_name, "clearTaskInstances")
         else:
-            trigger_url = os.path.join(airflow_api_url, f"dags/{dag_name}/dagRuns")
+            trigger_url = airflow_dag_url(airflow_api_url, dag_name, "dagRuns")
 
         logger.info(f"Using Airflow API URL: {trigger_url}")
 
-        if "AIRFLOW_BASIC_AUTH" in os.environ:
-            auth_header = "Basic " + os.environ["AIRFLOW_BASIC_AUTH"]
+        # Basic authentication is set on the Airflow session, otherwise use the Unity token
+        if "Authorization" in self._airflow.headers:
+            headers = None
         else:
-            auth_header = "Bearer " + self.unity._session.get_auth().get_token()
-
-        headers = {
-            "Content-type": "application/json", 
-            "Accept": "text/json",
-            "Authorization": auth_header
-        }
+            headers = self._auth_header()
 
         dt_now = datetime.now(timezone.utc)
         logical_date = dt_now.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -124,7 +181,7 @@ class TropessDAGRunner(DataTool):
                 "dag_run_id": run_id,
                 "logical_date": logical_date,
                 "conf": {
-                    "process_args": json.dumps(process_args),
+                    "process_args": fast_json.dumps(process_args),
                     "process_workflow": process_workflow,
                     "stac_json": stac_json,
                     "request_instance_type": REQUEST_INSTANCE_TYPE,
@@ -134,8 +191,8 @@ class TropessDAGRunner(DataTool):
                 },
             }
 
-        logger.debug("DAG parameters:")
-        logger.debug(pformat(data, indent=2))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("DAG parameters:\n" + pformat(data, indent=2))
 
         if not rerun:
             logger.debug("process_args from DAG parameters as one line:")
@@ -144,24 +201,35 @@ class TropessDAGRunner(DataTool):
         if trigger:
             logger.info(f"Triggering Airflow DAG at: {trigger_url}")
 
-            result = requests.post(
-                trigger_url, json=data, headers=headers,
+            # Encode the request body once here instead of with requests' stdlib json encoder, Content-type is set on the session
+            body = fast_json.dumpb(data)
+
+            result = self._airflow.post(
+                trigger_url, data=body, headers=headers,
                 timeout=15,
             )
 
+            # A cached token may have been revoked or expired early, retry once with a fresh one
+            if result.status_code == 401 and headers is not None:
+                logger.debug("Airflow rejected the cached token, retrying with a refreshed token")
+                result = self._airflow.post(
+                    trigger_url, data=body, headers=self._auth_header(force_refresh=True),
+                    timeout=15,
+                )
+
             if result.status_code != 200:
                 raise Exception(f"Error triggering Airflow DAG at {trigger_url}: {result.text}")
 
-            result_json = result.json()
-            logger.debug("Response JSON:")
-            logger.debug(pformat(result_json, indent=2))
+            result_json = fast_json.loads(result.content)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response JSON:\n" + pformat(result_json, indent=2))
 
         else:
             logger.info("Airflow DAG dry-run only")
 
     def _verify_s3_path(self, base_path, data_path):
 
-        s3 = boto3.client('s3')
+        s3 = s3_client()
 
         # Path must end with slash to see it as a "directory"
         if not data_path.endswith('/'):
@@ -171,69 +239,65 @@ class TropessDAGRunner(DataTool):
         url_full_path = os.path.join(base_path, data_path)
         url_parts = urlparse(url_full_path, allow_fragments=False)
 
-        # Query for contents of the URL if any
-        resp = s3.list_objects(Bucket=url_parts.netloc,
-                               Prefix=url_parts.path.lstrip("/"), Delimiter='/')
+        bucket = url_parts.netloc
+        prefix = url_parts.path.lstrip("/")
 
-        common_prefixes = resp.get('CommonPrefixes', [])
+        # Fail fast on a mistyped or inaccessible bucket before probing for sub directories
+        try:
+            s3.head_bucket(Bucket=bucket)
+        except s3.exceptions.ClientError as exc:
+            raise Exception(f"Could not access S3 bucket {bucket} of {url_full_path}: {exc}") from exc
 
-        # Verify the path exists and it contains files        
-        if 'Contents' not in resp:
-            raise Exception(f"Could not find anything at S3 URL: {url_full_path}")
+        # Probe each expected "directory" for a single key rather than listing everything at the path
+        def _first_key(key_prefix):
+            resp = s3.list_objects_v2(Bucket=bucket, Prefix=key_prefix, MaxKeys=1)
+            contents = resp.get('Contents', [])
+            return contents[0]['Key'] if contents else None
 
-        if len(common_prefixes) == 0:
-            raise Exception(f"No files or directories found at {url_full_path}")
+        with ThreadPoolExecutor(max_workers=len(EXPECTED_INGEST_SUBDIRS)) as executor:
+            sub_dir_keys = list(executor.map(_first_key, [ f"{prefix}{expected_dir}/" for expected_dir in EXPECTED_INGEST_SUBDIRS ]))
 
-        # Verify expected items are located at the path
-        path_sub_items = [ os.path.basename(p['Prefix'].rstrip("/")) for p in common_prefixes ]
+        # Verify the path exists and contains files, only probed separately when none of the expected items are found
+        if all(key is None for key in sub_dir_keys) and _first_key(prefix) is None:
+            raise Exception(f"Could not find anything at S3 URL: {url_full_path}")
 
-        for expected_dir in EXPECTED_INGEST_SUBDIRS:
-            if expected_dir not in path_sub_items:
+        # Verify expected items are located at the path
+        for expected_dir, found_key in zip(EXPECTED_INGEST_SUBDIRS, sub_dir_keys):
+            if found_key is None:
                 raise Exception(f"Did not find {expected_dir} under {url_full_path}")
 
         # Log what we found at the S3 path
         logger.info(f"Ingesting data from S3 path: {url_full_path}")
-        logger.info("Path contains:")
-        for sub_dir in path_sub_items:
-            logger.info(f" - {sub_dir}")
-
+        logger.info("Found expected sub directories:")
+        for expected_dir, found_key in zip(EXPECTED_INGEST_SUBDIRS, sub_dir_keys):
+            logger.info(f" - {expected_dir}, first key: {found_key}")
 
     def _verify_file_url(self, url):
 
-        if response := requests.get(url).status_code != 200:
-            raise Exception(f"Invalid file url: {url}, get failed with status code: {response.status_code}")
-
-    def _extract_cwl_docker_version(self, cwl_workflow_filename):
-
-        with open(cwl_workflow_filename, "r") as yaml_output:
-            yaml_contents = yaml.safe_load(yaml_output)
+        # Only the status is needed, so avoid downloading the file body
+        response = self._http.head(url, allow_redirects=True, timeout=15)
 
-        docker_url = yaml_contents['requirements']['DockerRequirement']['dockerPull']
+        if response.status_code != 200:
+            raise Exception(f"Invalid file url: {url}, head failed with status code: {response.status_code}")
 
-        _, docker_version = docker_url.split(':', 2)
+    def _extract_cwl_docker_version(self, cwl_workflow_filename):
 
-        return docker_version
+        # Keyed by modification time so an edited CWL file is read again
+        return cwl_docker_version(os.path.abspath(cwl_workflow_filename), os.stat(cwl_workflow_filename).st_mtime)
 
     def _process_workflow_url(self, subcommand_name):
 
         # Find the process.cwl file for the current project/venue
         # Verify that it exists locally before assuming the URL we construct is valid
-        process_workflow_filename = CWL_WORKFLOW_FILENAME.format(
-            subcommand_dir=SUBCOMMAND_DIRS[subcommand_name],
-            project=self.unity._session._project,
-            venue=self.unity._session._venue,
-        ) 
-
-        cwl_workflow_filename = os.path.join(self.deploy_base_dir, process_workflow_filename)
-        if not os.path.exists(cwl_workflow_filename):
+        process_workflow_filename = self._workflow_filenames[subcommand_name]
+
+        cwl_workflow_filename = self._workflow_paths[subcommand_name]
+        if not os.path.isfile(cwl_workflow_filename):
             raise Exception(f"Could not find process CWL file: {process_workflow_filename}")
 
         docker_version = self._extract_cwl_docker_version(cwl_workflow_filename)
         
-        process_workflow_url = os.path.join(DEPLOY_FILES_BASE_URL, process_workflow_filename)
-
-        if (response := requests.get(process_workflow_url)).status_code != 200:
-            raise Exception(f"Invalid process CWL url: {process_workflow_url}, get failed with status code: {response.status_code}")
+        process_workflow_url = self._workflow_urls[subcommand_name]
 
         self._verify_file_url(process_workflow_url)
 
@@ -247,9 +311,6 @@ class TropessDAGRunner(DataTool):
         assert(input_data_base_path is not None)
         assert(collection_version is not None)
 
-        # Verify the S3 path is accessible
-        self._verify_s3_path(input_data_base_path, input_data_ingest_path)
-
         process_args = {
             "input_data_ingest_path": input_data_ingest_path,
             "collection_group_keyword": collection_group_keyword,
@@ -257,16 +318,20 @@ class TropessDAGRunner(DataTool):
             "collection_version": collection_version,
         }
         
-        process_workflow_url, docker_version = self._process_workflow_url("data_ingest")
-
         # Use the empty stac_json stored in the repo
-        stac_json_url = os.path.join(
-            DEPLOY_FILES_BASE_URL,
-            SUBCOMMAND_DIRS["data_ingest"],
-            "stage_in.json"
-        )
+        stac_json_url = DATA_INGEST_STAGE_IN_URL
+
+        # The verifications are independent network requests so run them concurrently
+        with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+            # Verify the S3 path is accessible
+            s3_future = executor.submit(self._verify_s3_path, input_data_base_path, input_data_ingest_path)
+            workflow_future = executor.submit(self._process_workflow_url, "data_ingest")
+            stac_json_future = executor.submit(self._verify_file_url, stac_json_url)
+
+            s3_future.result()
+            process_workflow_url, docker_version = workflow_future.result()
+            stac_json_future.result()
 
-        self._verify_file_url(stac_json_url)
         logger.info(f"Using STAC JSON: {stac_json_url}")
 
         # With verification done, trigger the Airflow run
@@ -283,9 +348,7 @@ class TropessDAGRunner(DataTool):
         stac_query_result = super().query_data_catalog(muses_collection_ids[0], processing_date)
 
         # Load a list of files found in the STAC results for verification purposes
-        nc_files = []
-        for feat in stac_query_result['features']:
-            nc_files += list(filter(lambda fn: re.search(r'\.nc$', fn), feat['assets'].keys()))
+        nc_files = [ fn for feat in stac_query_result['features'] for fn in feat['assets'] if fn.endswith('.nc') ]
 
         if len(nc_files) == 0:
             raise Exception(f"Found 0 files to process")
@@ -298,8 +361,13 @@ class TropessDAGRunner(DataTool):
 
     def py_tropess(self, collection_group, processing_date, product_type, processing_species, muses_collection_version, granule_version, sensor_set_str=None, trigger=False, rerun=False, **kwargs):
         
-        # Get information on files we want to process
-        stac_json_url = self.query_input_data(collection_group, sensor_set_str, muses_collection_version, processing_date)
+        # Get information on files we want to process while verifying the workflow
+        with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+            stac_json_future = executor.submit(self.query_input_data, collection_group, sensor_set_str, muses_collection_version, processing_date)
+            workflow_future = executor.submit(self._process_workflow_url, "py_tropess")
+
+            stac_json_url = stac_json_future.result()
+            process_workflow_url, docker_version = workflow_future.result()
 
         # Now construct arguments for DAG query
         process_args = {
@@ -310,8 +378,6 @@ class TropessDAGRunner(DataTool):
         # Only set if not a null or none value
         if processing_species is not None and processing_species != "null":
             process_args['processing_species'] = processing_species
-        
-        process_workflow_url, docker_version = self._process_workflow_url("py_tropess")
 
         # Unique identifier formed by inputs
         run_id = f"TROPESS-py_tropess_{docker_version}-{collection_group.keyword}-{sensor_set_str}-{processing_date}-{product_type}"
@@ -401,11 +467,8 @@ def main():
     command_args = read_job_file(args.subparser_name, args.deploy_base_dir)
     command_args.update({ k:v for k,v in args_dict.items() if v is not None})
 
-    # Find collection group object from keyword name
-    collection_group_obj = CollectionGroup.get_collection_group(args_dict['collection_group_keyword'])
-    if collection_group_obj is None:
-        raise Exception(f"Invalid collection_group_keyword: {args_dict['collection_group_keyword']}")
-    command_args['collection_group'] = collection_group_obj 
+    # Find collection group object from keyword name, the product spec is first loaded here
+    command_args['collection_group'] = get_collection_group(args_dict['collection_group_keyword'])
 
     args.func(dag_trigger, **command_args)
 
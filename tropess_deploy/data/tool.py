@@ -1,94 +1,189 @@
-import json
+import re
+import time
 import logging
+import functools
+from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor
 
-import dateparser
-
-from unity_sds_client.unity_services import UnityServices as services
-from unity_sds_client.resources.collection import Collection
+from .. import fast_json
+from ..mdps.tool import MdpsTool
 
-import tropess_product_spec.config as tps_config
-from tropess_product_spec.config import collection_group_combinations
-from tropess_product_spec.product_naming import format_short_name
-from tropess_product_spec.schema import SensorSet
+# Seconds that a listing of data services collections is reused
+COLLECTIONS_CACHE_TTL = 60
 
-from ..mdps.tool import MdpsTool
+# Maximum number of collections queried from the data catalog at once
+QUERY_WORKERS = 8
 
 logger = logging.getLogger()
 
+# Strict ISO 8601 dates, alone or followed by a time
+_ISO_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}(T|$)")
+
+@functools.lru_cache(maxsize=4096)
+def date_ymd(date_str):
+    "Date string normalized to YYYY-MM-DD, the same dates are seen many times over collections and STAC items"
+
+    # Dates are usually given in ISO 8601 already, only free form input needs dateparser
+    try:
+        if _ISO_DATE_RE.match(date_str):
+            return date.fromisoformat(date_str[:10]).isoformat()
+        return datetime.fromisoformat(date_str).strftime("%Y-%m-%d")
+    except ValueError:
+        pass
+
+    # Imported on first use since loading its locale data is slow
+    import dateparser
+
+    parsed = dateparser.parse(date_str)
+    if parsed is None:
+        raise ValueError(f"Invalid date value: {date_str}")
+
+    return parsed.strftime("%Y-%m-%d")
+
+def build_date_filter(processing_date=None, date_range=None):
+    "Data catalog query filter for a processing date or date range, None when neither is given"
+
+    # Get consistent date string for DS query -> YYYY-MM-DD
+    if date_range is not None:
+        try:
+            start_date, stop_date = [ date_ymd(d) for d in date_range ]
+        except ValueError as exc:
+            raise ValueError(f"Invalid date range values: {date_range}") from exc
+        return f"processing_datetime>='{start_date}' and processing_datetime<='{stop_date}'"
+    elif processing_date is not None:
+        return f"processing_datetime='{date_ymd(processing_date)}'"
+    else:
+        return None
+
+@functools.lru_cache(maxsize=None)
+def get_collection_group(collection_group_keyword):
+    "Collection group object for a keyword name from the product spec"
+
+    # Import both because the first initiates beginning in the config
+    import tropess_product_spec.config as tps_config
+    from tropess_product_spec.schema import CollectionGroup
+
+    collection_group_obj = CollectionGroup.get_collection_group(collection_group_keyword)
+    if collection_group_obj is None:
+        raise Exception(f"Invalid collection_group_keyword: {collection_group_keyword}")
+
+    return collection_group_obj
+
+@functools.lru_cache(maxsize=256)
+def _resolve_sensor_set(collection_group_keyword, sensor_set_query):
+    "Sensor set object for a sensor set keyword or an alias valid for the collection group"
+
+    import tropess_product_spec.config as tps_config
+
+    # Sensor Set object from keyword
+    if (sensor_set_obj := tps_config.sensor_sets.get(sensor_set_query)) is not None:
+        return sensor_set_obj
+    
+    # A collection group has a set of sensor sets that are valid, the mappings are mapped by the string used for the directory structure
+    # Try the string with this alias
+    sensor_set_mapping = get_collection_group(collection_group_keyword).sensor_set_mappings.get(sensor_set_query)
+    if sensor_set_mapping is not None and (sensor_set_obj := sensor_set_mapping.sensor_set) is not None:
+        return sensor_set_obj
+    
+    raise Exception(f'Could not determine sensor set from string: "{sensor_set_query}"')
+
+@functools.lru_cache(maxsize=None)
+def _short_names(collection_group_keyword, sensor_set_alias=None):
+    "TROPESS short names for a collection group keyword as a tuple, these only depend on the product spec configuration"
+
+    # Product spec configuration is loaded on first use to keep command line startup fast
+    from tropess_product_spec.config import collection_group_combinations
+    from tropess_product_spec.product_naming import format_short_name
+
+    sensor_set_filter = None
+    if sensor_set_alias is not None:
+        sensor_set_filter = [sensor_set_alias]
+
+    return tuple(format_short_name(group_kw, product_kw, sensor_set_kw, species_kw)
+                 for group_kw, product_kw, sensor_set_kw, species_kw in collection_group_combinations(collection_groups_filter=[collection_group_keyword], sensor_sets_filter=sensor_set_filter))
+
+@functools.lru_cache(maxsize=None)
+def _mdps_collection_ids(mdps_project, mdps_venue, short_names, collection_version):
+    "MDPS collection IDs for a tuple of short names"
+
+    id_prefix = f"URN:NASA:UNITY:{mdps_project}:{mdps_venue}:"
+    id_suffix = f"___{collection_version}"
+
+    return tuple(id_prefix + short_name + id_suffix for short_name in short_names)
+
 class DataTool(MdpsTool):
+
+    # Data service clients shared between tools using the same Unity session
+    _data_managers = {}
     
     def __init__(self, env_config_file=None, **kwargs):
         super().__init__(env_config_file=env_config_file, **kwargs)
 
-        self.data_manager = self.unity.client(services.DATA_SERVICE)
+        self.data_manager = DataTool._data_managers.get(self._unity_key)
+        if self.data_manager is None:
+            from unity_sds_client.unity_services import UnityServices as services
+
+            self.data_manager = DataTool._data_managers[self._unity_key] = self.unity.client(services.DATA_SERVICE)
+
+        self._collections_cache = {}
+
+    def _collections(self, limit=None, ttl=COLLECTIONS_CACHE_TTL):
+        "Return data services collections, reusing a recent listing made with the same limit"
+
+        cached = self._collections_cache.get(limit)
+        if cached is not None and time.time() - cached[0] < ttl:
+            return cached[1]
+
+        collections = list(self.data_manager.get_collections(limit=limit))
+        self._collections_cache[limit] = (time.time(), collections)
+
+        return collections
     
     def collection_group_short_names(self, collection_group, sensor_set=None):
         "Return all TROPESS short names, aka the DAAC collection ID for a collection group"
 
-        short_name_list = []
-
-        sensor_set_filter = None
+        sensor_set_alias = None
         if sensor_set is not None:
-            sensor_set_filter = [sensor_set.alias]
-
-        # Create TROPESS shortname list
-        for group_kw, product_kw, sensor_set_kw, species_kw in collection_group_combinations(collection_groups_filter=[collection_group.keyword], sensor_sets_filter=sensor_set_filter):
-            short_name = format_short_name(group_kw, product_kw, sensor_set_kw, species_kw)
-            short_name_list.append(short_name)
+            sensor_set_alias = sensor_set.alias
 
-        return short_name_list
+        # Copied into a list so callers can not alter the cached tuple
+        return list(_short_names(collection_group.keyword, sensor_set_alias))
 
     def muses_short_names(self, collection_group, sensor_set=None):
         "Return all TROPESS short names, aka the DAAC collection ID for a collection group"
 
-        short_name_list = []
-
-        if sensor_set is not None:
-            sensor_set_list = [ sensor_set ]
-        else:
-            sensor_set_list = collection_group.sensor_sets.values()
+        sensor_set_list = [ sensor_set ] if sensor_set is not None else collection_group.sensor_sets.values()
 
         # Create MUSES shortname list
-        for sensor_set in sensor_set_list:
-            short_name = f'MUSES-{sensor_set.short_name}-{collection_group.short_name}'
-            short_name_list.append(short_name)
-
-        return short_name_list
+        group_short_name = collection_group.short_name
+        return [ f'MUSES-{ss.short_name}-{group_short_name}' for ss in sensor_set_list ]
 
     def mdps_collection_ids(self, tropess_short_names, collection_version):
         "Generate MDPS collection IDs from TROPESS short names"
     
         # Create a MDPS/Unity collection for each TROPESS product shortname in the collection group
-        our_collection_ids = []
-        for short_name in tropess_short_names:
-            collection_id = f"URN:NASA:UNITY:{self.mdps_project}:{self.mdps_venue}:" + f"{short_name}___{collection_version}"
-            our_collection_ids.append(collection_id)
- 
-        return our_collection_ids
+        return list(_mdps_collection_ids(self.mdps_project, self.mdps_venue, tuple(tropess_short_names), collection_version))
+
+    def _daac_pairs(self, collection_group, collection_version):
+        "Yield TROPESS short names, aka the DAAC collection IDs, paired with their MDPS collection ID"
+
+        short_names = self.collection_group_short_names(collection_group)
+        yield from zip(short_names, self.mdps_collection_ids(short_names, collection_version))
 
     def _find_sensor_set(self, collection_group_obj, sensor_set_query):
         "Find a sensor set string via straight keyword or from an alias attached to the collection_group"
 
         if sensor_set_query is None:
             return None
+
+        # Import both because the first initiates beginning in the config
+        import tropess_product_spec.config as tps_config
+        from tropess_product_spec.schema import SensorSet
         
         if isinstance(sensor_set_query, SensorSet):
             return sensor_set_query
 
-        # Sensor Set object from keyword
-        sensor_set_obj = tps_config.sensor_sets.get(sensor_set_query, None)
-        
-        # A collection group has a set of sensor sets that are valid, the mappings are mapped by the string used for the directory structure
-        # Try the string with this alias
-        if sensor_set_obj is None:
-            sensor_set_mapping = collection_group_obj.sensor_set_mappings.get(sensor_set_query, None)
-            if sensor_set_mapping is not None:
-                sensor_set_obj = sensor_set_mapping.sensor_set
-        
-        if sensor_set_obj is None:
-            raise Exception(f'Could not determine sensor set from string: "{sensor_set_query}"')
-
-        return sensor_set_obj
+        return _resolve_sensor_set(collection_group_obj.keyword, sensor_set_query)
 
     def muses_collection_ids(self, collection_group, collection_version, sensor_set_str=None):
 
@@ -104,35 +199,42 @@ class DataTool(MdpsTool):
         short_names = self.collection_group_short_names(collection_group, sensor_set=sensor_set_obj)
         return self.mdps_collection_ids(short_names, collection_version)
 
-    def query_data_catalog(self, mdps_collection_id, processing_date=None, date_range=None, limit=1000):
+    def query_data_catalog(self, mdps_collection_id, processing_date=None, date_range=None, limit=1000, query_filter=None):
         
         logger.debug(f"Searching data catalog for MUSES data for collection {mdps_collection_id} on date {processing_date}")
 
-        # Get consistent date string for DS query -> YYYY-MM-DD
-        if date_range is not None:
-            try:
-                start_date, stop_date = [ dateparser.parse(d).strftime("%Y-%m-%d") for d in date_range ]
-            except AttributeError as exc:
-                raise AttributeError(f"Invalid date range values: {date_range}")
-            query_filter = f"processing_datetime>='{start_date}' and processing_datetime<='{stop_date}'"
-        elif processing_date is not None:
-            processing_date = dateparser.parse(processing_date).strftime("%Y-%m-%d")
-            query_filter = f"processing_datetime='{processing_date}'"
-        else:
-            query_filter = None
+        # A filter built once by the caller can be reused across many collections
+        if query_filter is None:
+            query_filter = build_date_filter(processing_date, date_range)
             
         if query_filter is not None:
             logger.debug(f"Query filter: {query_filter}")
 
+        from unity_sds_client.resources.collection import Collection
+
         stac_query_result = self.data_manager.get_collection_data(Collection(mdps_collection_id), limit=limit, filter=query_filter, output_stac=True)
 
-        if 'features' not in stac_query_result:
-            raise Exception(f"Error querying data catalog: {stac_query_result}")
+        if stac_query_result.get('features') is None:
+            raise Exception(f"Error querying data catalog: {stac_query_result!r}")
 
         return stac_query_result
 
+    def query_data_catalog_many(self, mdps_collection_ids, processing_date=None, date_range=None, limit=1000, max_workers=QUERY_WORKERS):
+        "Query the data catalog for several collection ids concurrently, returns (collection id, STAC result) pairs in the order given"
+
+        # The ids are read twice below, so any iterable is materialized first
+        mdps_collection_ids = list(mdps_collection_ids)
+
+        query_filter = build_date_filter(processing_date, date_range)
+
+        def _query(mdps_collection_id):
+            return self.query_data_catalog(mdps_collection_id, processing_date=processing_date, limit=limit, query_filter=query_filter)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(zip(mdps_collection_ids, executor.map(_query, mdps_collection_ids)))
+
     def write_stac_catalog(self, stac_query_result, stac_output_filename):
         # Write out STAC file
         logger.info(f"Writing STAC result to: {stac_output_filename}")
-        with open(stac_output_filename, "w") as stage_in_file:
-            json.dump(stac_query_result, stage_in_file)
\ No newline at end of file
+        with open(stac_output_filename, "wb") as stage_in_file:
+            stage_in_file.write(fast_json.dumpb(stac_query_result))
\ No newline at end of file
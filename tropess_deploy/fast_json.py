@@ -0,0 +1,35 @@
+"""
+JSON encoding and decoding that uses orjson when it is installed and
+falls back to the standard library json module otherwise
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def loads(data):
+    "Decode JSON from str or bytes"
+
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+def dumps(obj):
+    "Encode an object as a compact JSON str"
+
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+
+    return json.dumps(obj, separators=(",", ":"))
+
+def dumpb(obj):
+    "Encode an object as compact JSON bytes"
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+
+    return json.dumps(obj, separators=(",", ":")).encode()
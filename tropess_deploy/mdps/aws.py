@@ -0,0 +1,25 @@
+import functools
+
+# Sized so concurrent verification requests do not wait on botocore's default pool of 10
+MAX_POOL_CONNECTIONS = 50
+
+def _client_config():
+    from botocore.config import Config
+
+    return Config(max_pool_connections=MAX_POOL_CONNECTIONS, retries={'max_attempts': 3, 'mode': 'adaptive'})
+
+@functools.cache
+def s3_client():
+    "Shared S3 client, creating a client resolves credentials and loads the service model"
+
+    # Imported here since loading boto3 is slow and not every command needs it
+    import boto3
+
+    return boto3.client('s3', config=_client_config())
+
+@functools.cache
+def ssm_client():
+    "Shared SSM parameter store client"
+
+    import boto3
+    return boto3.client('ssm', config=_client_config())
@@ -0,0 +1,32 @@
+# Defaults for pooled connections to MDPS services
+DEFAULT_POOL_CONNECTIONS = 16
+DEFAULT_POOL_MAXSIZE = 32
+
+# Response statuses considered transient and retried
+DEFAULT_RETRY_STATUSES = (502, 503, 504)
+
+def create_session(pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                   retries=3, backoff_factor=0.3, status_forcelist=DEFAULT_RETRY_STATUSES,
+                   allowed_methods=None):
+    "Create a requests Session that keeps connections alive between calls"
+
+    # Imported here to keep command line startup fast
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Statuses are only retried for allowed_methods, when not given urllib3's idempotent methods are used
+    if allowed_methods is None:
+        allowed_methods = Retry.DEFAULT_ALLOWED_METHODS
+
+    # Once retries run out the last response is returned, so callers can report its status and body
+    max_retries = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=status_forcelist,
+                        allowed_methods=allowed_methods, respect_retry_after_header=True, raise_on_status=False)
+
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=max_retries)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return session
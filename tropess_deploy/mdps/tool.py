@@ -1,29 +1,69 @@
 import os
+import time
+import base64
+import functools
 import logging
+import threading
 
 from dotenv import load_dotenv
 
-from unity_sds_client.unity import Unity
-from unity_sds_client.unity import UnityEnvironments
+from .. import fast_json
+
+# How long a Unity token is reused when its expiry can not be read from the token itself
+TOKEN_CACHE_SECONDS = 300
+
+# Refresh a cached token this many seconds before it is due to expire
+TOKEN_REFRESH_MARGIN = 30
 
 logger = logging.getLogger()
 
+def token_expiry(token, default_lifetime=TOKEN_CACHE_SECONDS):
+    "Expiry time of a JWT from its exp claim, or default_lifetime seconds from now if it has none"
+
+    try:
+        payload = token.split('.')[1]
+        claims = fast_json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + default_lifetime
+
+@functools.lru_cache(maxsize=None)
+def mdps_environment(env_config_file=None):
+    "MDPS project, venue and environment names, the .env file is only loaded once per process"
+
+    # Load environment variables from a .env file
+    load_dotenv(dotenv_path=env_config_file)
+
+    return (os.environ.get("PROJECT", "unity"),
+            os.environ.get("VENUE", "ops"),
+            os.environ.get("ENVIRONMENT", "PROD"))
+
 class MdpsTool(object):
 
+    # Logged in Unity clients shared between tools, keyed by project, venue and environment
+    _unity_sessions = {}
+
     def __init__(self, env_config_file=None, **kwargs):
 
-        # Load environment variables from a .env file
-        load_dotenv(dotenv_path=env_config_file)
+        self.mdps_project, self.mdps_venue, self.mdps_env = mdps_environment(env_config_file)
+
+        self._unity_key = (self.mdps_project, self.mdps_venue, self.mdps_env)
 
-        self.mdps_project = os.environ.get("PROJECT", "unity")
-        self.mdps_venue = os.environ.get("VENUE", "ops")
-        self.mdps_env = os.environ.get("ENVIRONMENT", "PROD")
+        self.unity = MdpsTool._unity_sessions.get(self._unity_key)
+        if self.unity is None:
+            self.unity = MdpsTool._unity_sessions[self._unity_key] = self.login_unity()
 
-        self.unity = self.login_unity()
+        # Cached token expiry and Authorization header, replaced together so concurrent readers never see a partial update
+        self._auth_state = None
+        self._auth_lock = threading.Lock()
 
     def login_unity(self):
         "Initialize unity-sds-client"
 
+        # Imported here to keep command line startup fast
+        from unity_sds_client.unity import Unity
+        from unity_sds_client.unity import UnityEnvironments
+
         logger.debug(f"Logging into Unity/MDPS with project = {self.mdps_project}, venue = {self.mdps_venue}, environment = {self.mdps_env}")
 
         env = UnityEnvironments[self.mdps_env]
@@ -31,4 +71,21 @@ class MdpsTool(object):
         s.set_project(self.mdps_project)
         s.set_venue(self.mdps_venue)
 
-        return s
\ No newline at end of file
+        return s
+
+    def _auth_header(self, force_refresh=False):
+        "Authorization header for MDPS requests, the token is only refetched when near expiry or forced"
+
+        auth_state = self._auth_state
+        if not force_refresh and auth_state is not None and time.time() <= auth_state[0] - TOKEN_REFRESH_MARGIN:
+            return auth_state[1]
+
+        # Only one thread fetches a token, the others wait for it and reuse the result
+        with self._auth_lock:
+            auth_state = self._auth_state
+            if force_refresh or auth_state is None or time.time() > auth_state[0] - TOKEN_REFRESH_MARGIN:
+                token = self.unity._session.get_auth().get_token()
+                auth_state = (token_expiry(token), {"Authorization": "Bearer " + token})
+                self._auth_state = auth_state
+
+        return auth_state[1]